@@ -5,19 +5,27 @@ Designed to mimic natural user activity and avoid detection as automated traffic
 """
 
 import os
-import json
 import random
+import sys
 import time
-import requests
-from datetime import datetime, timedelta
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
+try:
+    import orjson  # Optional: faster call log parsing/serialization
+except ImportError:
+    orjson = None
+
 # Configuration
 WEBHOOK_URL = os.environ.get('N8N_WEBHOOK_URL')
 TIMEZONE = ZoneInfo('Europe/Rome')
 CALL_LOG_FILE = 'call_log.json'
 MAX_CALLS_PER_MONTH = 1800
 
+# Let n8n wait out the human jitter instead of the Actions runner. The workflow
+# needs a Wait node that reads `delay_seconds` from the webhook payload.
+DELAY_IN_N8N = os.environ.get('N8N_DELAY_IN_WORKFLOW', '').lower() == 'true'
+
 # Business hours: 9 AM to 5 PM Rome time
 BUSINESS_START = 9
 BUSINESS_END = 17
@@ -27,29 +35,97 @@ LUNCH_START = 12
 LUNCH_END = 14
 LUNCH_ACTIVITY_REDUCTION = 0.3
 
+# Base hour-skip probability, indexed by hour of day
+_HOUR_SKIP_BASE = [
+    0.05 if 9 <= h < 10     # Early morning: getting started
+    else 0.08 if 10 <= h < 12   # Mid-morning: very active
+    else 0.25 if 12 <= h < 14   # Lunch time: higher skip chance
+    else 0.10 if 14 <= h < 16   # Afternoon: active again
+    else 0.15                   # Late afternoon: winding down
+    for h in range(24)
+]
+
+# Day-of-week activity as (base, min jitter, max jitter); Monday = 0
+_DAY_MULT_BASE = {
+    0: (0.85, -0.05, 0.10),  # Monday: slower start (0.80-0.95)
+    4: (0.90, -0.10, 0.10),  # Friday: variable (0.80-1.00)
+}
+_DAY_MULT_DEFAULT = (1.0, -0.05, 0.05)  # Tuesday-Thursday: mostly active (0.95-1.05)
+
+# Shared HTTP session, created on first use by get_session()
+_SESSION = None
+
+# Call log parsed from disk, shared by every caller within a single run
+_CACHED_LOG = None
+
+
+def get_session():
+    """Get the shared HTTP session (keeps the connection alive across retries)."""
+    global _SESSION
+    if _SESSION is None:
+        # Imported here so runs that skip the webhook never pay for requests
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        _SESSION = requests.Session()
+        _SESSION.mount('https://', HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=100,
+            max_retries=Retry(
+                total=2,
+                read=0,  # Never resend once n8n may have received the request
+                backoff_factor=0.3,
+                status_forcelist=[502, 503],  # 504 may mean n8n is still running it
+                allowed_methods=frozenset(['POST']),  # POST is not retried by default
+                respect_retry_after_header=False,  # Don't idle the runner on a long Retry-After
+            ),
+        ))
+    return _SESSION
+
 
 def load_call_log():
-    """Load the call log from file."""
-    if os.path.exists(CALL_LOG_FILE):
-        with open(CALL_LOG_FILE, 'r') as f:
-            return json.load(f)
-    return {'month': None, 'count': 0}
+    """Load the call log from file (read once per run, then cached)."""
+    global _CACHED_LOG
+    if _CACHED_LOG is None:
+        try:
+            with open(CALL_LOG_FILE, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            _CACHED_LOG = {'month': None, 'count': 0}
+        else:
+            if orjson:
+                _CACHED_LOG = orjson.loads(data)
+            else:
+                import json
+                _CACHED_LOG = json.loads(data)
+    return _CACHED_LOG
 
 
 def save_call_log(log):
-    """Save the call log to file."""
-    with open(CALL_LOG_FILE, 'w') as f:
-        json.dump(log, f, indent=2)
+    """Save the call log to file atomically and keep the cached copy in sync."""
+    global _CACHED_LOG
+    _CACHED_LOG = log
+    if orjson:
+        data = orjson.dumps(log, option=orjson.OPT_INDENT_2)
+    else:
+        import json
+        data = json.dumps(log, indent=2).encode()
+    # Write a sibling file and rename it over the log, so a crash mid-write
+    # never leaves a truncated call_log.json behind
+    tmp_file = CALL_LOG_FILE + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, CALL_LOG_FILE)
 
 
-def get_current_month():
+def get_current_month(now):
     """Get current month in YYYY-MM format."""
-    return datetime.now(TIMEZONE).strftime('%Y-%m')
+    return f"{now.year:04d}-{now.month:02d}"
 
 
-def is_vacation_period():
+def is_vacation_period(now):
     """Check if it's a vacation period (August, Christmas, or random week)."""
-    now = datetime.now(TIMEZONE)
     month = now.month
     day = now.day
 
@@ -63,50 +139,30 @@ def is_vacation_period():
 
     # Random vacation weeks (10% chance per week)
     week_number = now.isocalendar()[1]
-    random.seed(f"{now.year}-{week_number}")  # Consistent per week
-    if random.random() < 0.10:
+    # Consistent per week; a local generator leaves the global RNG untouched
+    if random.Random(f"{now.year}-{week_number}").random() < 0.10:
         return True
 
     return False
 
 
-def is_business_hours():
+def is_business_hours(weekday, hour):
     """Check if current time is within business hours (9 AM - 5 PM Rome time)."""
-    now = datetime.now(TIMEZONE)
-    hour = now.hour
+    # Weekday (Saturday = 5, Sunday = 6) and business hours check
+    return weekday < 5 and BUSINESS_START <= hour < BUSINESS_END
 
-    # Weekend check
-    if now.weekday() >= 5:  # Saturday = 5, Sunday = 6
-        return False
 
-    # Business hours check
-    return BUSINESS_START <= hour < BUSINESS_END
-
-
-def get_day_activity_multiplier():
+def get_day_activity_multiplier(weekday):
     """Get activity multiplier based on day of week with randomness."""
-    now = datetime.now(TIMEZONE)
-    day = now.weekday()  # Monday = 0, Sunday = 6
-
     # Add randomness to each day instead of fixed multipliers
-    if day == 0:  # Monday: slower start
-        base = 0.85
-        multiplier = base + random.uniform(-0.05, 0.10)  # 0.80-0.95
-    elif day == 4:  # Friday: variable (sometimes distracted, sometimes productive)
-        base = 0.90
-        multiplier = base + random.uniform(-0.10, 0.10)  # 0.80-1.00
-    else:  # Tuesday-Thursday: mostly active but with variation
-        base = 1.0
-        multiplier = base + random.uniform(-0.05, 0.05)  # 0.95-1.05
+    base, low, high = _DAY_MULT_BASE.get(weekday, _DAY_MULT_DEFAULT)
+    multiplier = base + random.uniform(low, high)
 
     return max(0.7, min(multiplier, 1.05))  # Keep within reasonable bounds
 
 
-def get_lunch_multiplier():
+def get_lunch_multiplier(hour):
     """Get activity multiplier during lunch hours with randomness."""
-    now = datetime.now(TIMEZONE)
-    hour = now.hour
-
     if LUNCH_START <= hour < LUNCH_END:
         # Variable lunch behavior - sometimes people work through lunch, sometimes not
         base_reduction = LUNCH_ACTIVITY_REDUCTION + random.uniform(-0.15, 0.10)
@@ -115,89 +171,71 @@ def get_lunch_multiplier():
     return 1.0
 
 
-def should_skip_day():
+def get_day_skip_chance():
     """Random chance to skip entire day - varies by day."""
     # Don't use seeded random - make it truly unpredictable
     # Base chance is 3%, but add some randomness
-    skip_chance = random.uniform(0.02, 0.05)  # 2-5% chance
-    return random.random() < skip_chance
+    return random.uniform(0.02, 0.05)  # 2-5% chance
 
 
-def should_skip_hour():
+def get_hour_skip_chance(hour):
     """Random chance to skip current hour - varies throughout the day."""
-    now = datetime.now(TIMEZONE)
-
     # Base skip probability varies by time of day
-    hour = now.hour
-
-    # Early morning (9-10 AM): lower skip chance (getting started)
-    if 9 <= hour < 10:
-        base_skip = 0.05
-    # Mid-morning (10-12): very active
-    elif 10 <= hour < 12:
-        base_skip = 0.08
-    # Lunch time (12-14): higher skip chance
-    elif 12 <= hour < 14:
-        base_skip = 0.25
-    # Afternoon (14-16): active again
-    elif 14 <= hour < 16:
-        base_skip = 0.10
-    # Late afternoon (16-17): winding down
-    else:
-        base_skip = 0.15
+    base_skip = _HOUR_SKIP_BASE[hour]
 
     # Add randomness to the base probability
     skip_chance = base_skip + random.uniform(-0.03, 0.05)
-    skip_chance = max(0, min(skip_chance, 0.4))  # Keep between 0-40%
-
-    return random.random() < skip_chance
+    return max(0, min(skip_chance, 0.4))  # Keep between 0-40%
 
 
-def should_execute():
+def should_execute(now):
     """Determine if webhook should be called based on all factors."""
+    weekday = now.weekday()
+    hour = now.hour
+
+    # Cheap clock-only checks first, so most runs never touch the call log
+
+    # Check business hours
+    if not is_business_hours(weekday, hour):
+        print("🌙 Outside business hours. Skipping.")
+        return False
+
+    # Check vacation period
+    if is_vacation_period(now):
+        print("🏖️ Vacation period. Skipping.")
+        return False
+
     # Check monthly limit
     log = load_call_log()
-    current_month = get_current_month()
+    current_month = get_current_month(now)
 
-    # Reset counter if new month
+    # Reset counter if new month (persisted with the next save of this run)
     if log['month'] != current_month:
+        print("📊 New month detected. Counter reset.")
         log['month'] = current_month
         log['count'] = 0
-        save_call_log(log)
+    else:
+        print(f"📊 Calls this month: {log['count']}/{MAX_CALLS_PER_MONTH}")
 
     # Check if monthly limit reached
     if log['count'] >= MAX_CALLS_PER_MONTH:
         print(f"✋ Monthly limit reached ({MAX_CALLS_PER_MONTH} calls). Skipping.")
         return False
 
-    # Check vacation period
-    if is_vacation_period():
-        print("🏖️ Vacation period. Skipping.")
-        return False
-
-    # Check business hours
-    if not is_business_hours():
-        print("🌙 Outside business hours. Skipping.")
-        return False
-
-    # Check day skip
-    if should_skip_day():
-        print("📅 Random day skip. Skipping.")
-        return False
-
-    # Check hour skip
-    if should_skip_hour():
-        print("⏰ Random hour skip. Skipping.")
-        return False
+    # Day and hour skips fold into the execution probability, so a single
+    # draw below decides the outcome instead of one draw per check
+    day_skip = get_day_skip_chance()
+    hour_skip = get_hour_skip_chance(hour)
 
     # Calculate execution probability based on multipliers
-    day_mult = get_day_activity_multiplier()
-    lunch_mult = get_lunch_multiplier()
+    day_mult = get_day_activity_multiplier(weekday)
+    lunch_mult = get_lunch_multiplier(hour)
 
     # Variable base probability instead of fixed 95%
     base_probability = random.uniform(0.85, 0.98)  # 85-98% base chance
 
-    final_probability = base_probability * day_mult * lunch_mult
+    final_probability = ((1 - day_skip) * (1 - hour_skip)
+                         * base_probability * day_mult * lunch_mult)
 
     # Add occasional "micro-break" - random very low probability periods
     if random.random() < 0.05:  # 5% chance of micro-break
@@ -213,14 +251,19 @@ def should_execute():
 
 
 def add_human_jitter():
-    """Add random delay to simulate human interaction timing with exponential distribution."""
+    """Add random delay to simulate human interaction timing with exponential distribution.
+
+    Returns the delay in seconds. With DELAY_IN_N8N it is not slept here but
+    sent to n8n as `delay_seconds`.
+    """
     # Use exponential distribution for more realistic behavior
     # Most delays are short, but occasionally long delays occur
     # 80% of delays will be under 5 minutes, but can go up to 15 minutes
 
-    if random.random() < 0.15:  # 15% chance of "burst" activity (quick response)
+    u = random.random()
+    if u < 0.15:  # 15% chance of "burst" activity (quick response)
         jitter = random.uniform(0, 60)  # 0-1 minute
-    elif random.random() < 0.70:  # 70% normal activity
+    elif u < 0.85:  # 70% normal activity
         jitter = random.expovariate(1/180) # Average 3 minutes, but exponentially distributed
         jitter = min(jitter, 600)  # Cap at 10 minutes
     else:  # 15% chance of distracted/slow response
@@ -228,36 +271,42 @@ def add_human_jitter():
 
     minutes = jitter / 60
     print(f"⏱️ Adding human jitter: {jitter:.0f} seconds ({minutes:.1f} minutes)")
-    time.sleep(jitter)
+    if DELAY_IN_N8N:
+        print("📨 Delay handed to n8n (delay_seconds).")
+    else:
+        sys.stdout.flush()  # Show the decision before waiting
+        time.sleep(jitter)
+    return jitter
 
 
-def call_webhook():
+def call_webhook(now):
     """Call the n8n webhook."""
-    if not WEBHOOK_URL:
-        print("❌ Error: N8N_WEBHOOK_URL environment variable not set!")
-        return False
+    import requests
 
     try:
-        now = datetime.now(TIMEZONE)
         timestamp = now.isoformat()
 
         # Add human jitter before calling
-        add_human_jitter()
-
-        # Make the webhook call
-        response = requests.post(
+        jitter = add_human_jitter()
+
+        payload = {
+            'timestamp': timestamp,
+            'source': 'github-actions-scheduler',
+            'timezone': 'Europe/Rome'
+        }
+        if DELAY_IN_N8N:
+            payload['delay_seconds'] = round(jitter)
+
+        # Make the webhook call (body is never read; only the status matters)
+        with get_session().post(
             WEBHOOK_URL,
-            json={
-                'timestamp': timestamp,
-                'source': 'github-actions-scheduler',
-                'timezone': 'Europe/Rome'
-            },
-            timeout=30
-        )
-
-        response.raise_for_status()
+            json=payload,
+            timeout=30,
+            stream=True
+        ) as response:
+            response.raise_for_status()
 
-        # Update call log
+        # Update call log (cached instance from should_execute)
         log = load_call_log()
         log['count'] += 1
         log['last_call'] = timestamp
@@ -274,6 +323,11 @@ def call_webhook():
 
 def main():
     """Main execution function."""
+    # Fail before any decision work if the run can never call the webhook
+    if not WEBHOOK_URL:
+        print("❌ Error: N8N_WEBHOOK_URL environment variable not set!")
+        sys.exit(1)
+
     print("=" * 60)
     print("🤖 Smart Webhook Scheduler")
     print("=" * 60)
@@ -282,20 +336,12 @@ def main():
     print(f"🕐 Current time: {now.strftime('%Y-%m-%d %H:%M:%S %Z')}")
     print(f"📅 Day: {now.strftime('%A')}")
 
-    # Load current stats
-    log = load_call_log()
-    current_month = get_current_month()
-    if log['month'] == current_month:
-        print(f"📊 Calls this month: {log['count']}/{MAX_CALLS_PER_MONTH}")
-    else:
-        print(f"📊 New month detected. Counter will reset.")
-
     print("-" * 60)
 
     # Decide if we should execute
-    if should_execute():
+    if should_execute(now):
         print("✅ All checks passed. Calling webhook...")
-        call_webhook()
+        call_webhook(now)
     else:
         print("⏭️ Skipping this execution cycle.")
 